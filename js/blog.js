@@ -71,17 +71,21 @@ function refreshComment(data) {
   let oldComment = form.previousElementSibling;
   let comments = oldComment.parentNode;
   comments.removeChild(form);
+  // The new comment may have a different id than the old one, e.g., if the
+  // comment was archived while it was being edited.
+  let comment;
   if (!oldComment.previousElementSibling) {
     // This comment is first comment
     comments.removeChild(oldComment);
     comments.insertAdjacentHTML('afterbegin', data.comment);
+    comment = comments.firstElementChild;
   } else {
     // This is not the first comment
     let sibling = oldComment.previousElementSibling;
     comments.removeChild(oldComment);
     sibling.insertAdjacentHTML('afterend', data.comment);
+    comment = sibling.nextElementSibling;
   }
-  let comment = comments.querySelector('#' + data.id);
   addEvent(comment.querySelector('.delete-comment'), 'click', deleteComment);
   addEvent(comment.querySelector('.edit-comment'), 'click', tryEditComment);
 }
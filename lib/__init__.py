@@ -2,7 +2,12 @@
 """
 Module for app.
 
+- api.py
+- cache.py
 - handlers.py
+- identity.py
 - models.py
+- profiling.py
+- tasks.py
 - util.py
 """
@@ -0,0 +1,247 @@
+# api.py
+"""
+Contains the handlers of the versioned json read API, used by client side
+code to navigate without rendering full pages on the server.
+
+The following handlers are defined:
+- BlogListApiHandler
+- BlogApiHandler
+- CommentListApiHandler
+
+Responses carry an ETag, and conditional requests whose If-None-Match header
+matches it get an empty 304 response.
+"""
+
+import hashlib
+import json
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+
+from handlers import BaseHandler
+from handlers import check_cached_blog
+from models import BlogSummary
+from models import Comment
+from models import CommentSegment
+
+API_VERSION = 1
+
+# Number of items in a page of a list response.
+BLOG_PAGE_SIZE = 10
+COMMENT_PAGE_SIZE = 25
+
+# Prefix of the cursors that point into the comment segments of a blog.
+SEGMENT_CURSOR_PREFIX = 'seg:'
+
+def summary_json(summary):
+    """Converts a blog summary to a json compatible dictionary.
+
+    :param summary
+        The BlogSummary model.
+    """
+    return {
+        'id': summary.blog.urlsafe(),
+        'title': summary.title,
+        'author': summary.user.id(),
+        'date': summary.date.isoformat(),
+        'tease': summary.tease,
+        'likes': summary.like_count,
+        'comments': summary.comment_count
+    }
+
+def blog_json(blog, user_key=None):
+    """Converts a blog entry to a json compatible dictionary.
+
+    :param blog
+        The Blog model.
+    :param user_key
+        The key of the user making the request, if logged in.
+    """
+    return {
+        'id': blog.key.urlsafe(),
+        'title': blog.title,
+        'author': blog.user.id(),
+        'date': blog.date.isoformat(),
+        'lines': blog.lines,
+        'likes': len(blog.likes),
+        'liked': bool(user_key) and user_key in blog.likes,
+        'is_author': bool(user_key) and blog.is_author(user_key)
+    }
+
+def comment_json(comment, user_key=None):
+    """Converts a comment to a json compatible dictionary.
+
+    :param comment
+        The Comment model.
+    :param user_key
+        The key of the user making the request, if logged in.
+    """
+    return {
+        'id': comment.key.urlsafe(),
+        'author': comment.user.id(),
+        'date': comment.date.isoformat(),
+        'text': comment.text,
+        'is_author': bool(user_key) and comment.is_author(user_key)
+    }
+
+
+class ApiHandler(BaseHandler):
+    """Base class of the API handlers."""
+
+    @property
+    def user_key(self):
+        """The key of the user making the request, or None."""
+        return self.user.key if self.user else None
+
+    def get_cursor(self):
+        """Returns the cursor given in the request. A cursor of another query
+        only fails when a page is fetched with it, with a
+        datastore_errors.BadRequestError.
+
+        :raise
+            datastore_errors.BadValueError if the cursor is not valid.
+        """
+        return Cursor(urlsafe=self.request.get('cursor') or None)
+
+    def api_write(self, payload):
+        """Writes a compact json response with an ETag, or an empty 304
+        response if the client already has the payload.
+
+        :param payload
+            A json compatible dictionary.
+        """
+        body = json.dumps(
+            dict(payload, version=API_VERSION), separators=(',', ':'))
+        etag = hashlib.md5(body).hexdigest()
+        self.response.headers['Content-Type'] = 'application/json'
+        # Payloads depend on the session, so only the client may cache them.
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+        self.response.etag = etag
+        if etag in self.request.if_none_match:
+            self.response.status_int = 304
+            return
+        return self.write(body)
+
+    def page_write(self, key, items, next_cursor, more):
+        """Writes a page of a list response.
+
+        :param key
+            The name of the list in the payload.
+        :param items
+            The json compatible items in the page.
+        :param next_cursor
+            The cursor of the next page.
+        :param more
+            True if there are more items after this page.
+        """
+        payload = {key: items, 'cursor': None}
+        if more and next_cursor:
+            payload['cursor'] = next_cursor.urlsafe()
+        return self.api_write(payload)
+
+
+class BlogListApiHandler(ApiHandler):
+    """Handles requests for the list of blogs on the front page."""
+
+    def get(self):
+        """Writes a page of blog summaries in reverse chronological order."""
+        try:
+            cursor = self.get_cursor()
+        except datastore_errors.BadValueError:
+            return self.error(400)
+        query = BlogSummary.query().order(-BlogSummary.date)
+        try:
+            summaries, next_cursor, more = query.fetch_page(
+                BLOG_PAGE_SIZE, start_cursor=cursor)
+        except datastore_errors.BadRequestError:
+            # The cursor belongs to another query.
+            return self.error(400)
+        items = [summary_json(summary) for summary in summaries]
+        return self.page_write('blogs', items, next_cursor, more)
+
+
+class BlogApiHandler(ApiHandler):
+    """Handles requests for a blog entry."""
+
+    @check_cached_blog
+    def get(self, urlkey):
+        """Writes a blog entry.
+
+        :param urlkey
+            The blog key in url safe format.
+        """
+        return self.api_write(
+            {'blog': blog_json(self.db_resource, self.user_key)})
+
+
+class CommentListApiHandler(ApiHandler):
+    """Handles requests for the comments on a blog entry."""
+
+    @check_cached_blog
+    def get(self, urlkey):
+        """Writes a page of the comments on a blog in chronological order.
+
+        Archived comments are all older than the rest, so pages go through the
+        comment segments first, with cursors of the form seg:<id>:<offset>,
+        and then hand off to datastore cursors over the comments that have not
+        been archived.
+
+        :param urlkey
+            The blog key in url safe format.
+        """
+        blog_key = self.db_resource.key
+        cursor = self.request.get('cursor')
+        comments, position, live_cursor = [], None, None
+        if not cursor or cursor.startswith(SEGMENT_CURSOR_PREFIX):
+            try:
+                start_id, offset = self.parse_segment_cursor(cursor)
+            except ValueError:
+                return self.error(400)
+            comments, position = CommentSegment.get_page(
+                blog_key, start_id, offset, COMMENT_PAGE_SIZE)
+        else:
+            try:
+                live_cursor = self.get_cursor()
+            except datastore_errors.BadValueError:
+                return self.error(400)
+        next_cursor = None
+        if position:
+            next_cursor = '%s%d:%d' % ((SEGMENT_CURSOR_PREFIX,) + position)
+        else:
+            # The archived comments are exhausted, so the rest of the page
+            # comes from the comments that have not been archived.
+            query = Comment.query(Comment.blog == blog_key).order(Comment.date)
+            room = COMMENT_PAGE_SIZE - len(comments)
+            try:
+                live, live_next, more = query.fetch_page(
+                    room, start_cursor=live_cursor)
+            except datastore_errors.BadRequestError:
+                # The cursor belongs to another query, e.g. another blog.
+                return self.error(400)
+            # The query is eventually consistent, and can still return
+            # comments that were just archived.
+            archived = CommentSegment.comment_ids(blog_key)
+            comments += [comment for comment in live
+                         if comment.key.id() not in archived]
+            if more and live_next:
+                next_cursor = live_next.urlsafe()
+        items = [comment_json(comment, self.user_key) for comment in comments]
+        return self.api_write({'comments': items, 'cursor': next_cursor})
+
+    def parse_segment_cursor(self, cursor):
+        """Decodes a segment cursor.
+
+        :param cursor
+            The cursor, or an empty string for the first page.
+        :return
+            A tuple with the segment id and the offset in the segment.
+        :raise
+            ValueError if the cursor is not valid.
+        """
+        if not cursor:
+            return 0, 0
+        start_id, offset = cursor[len(SEGMENT_CURSOR_PREFIX):].split(':')
+        start_id, offset = int(start_id), int(offset)
+        if start_id < 0 or offset < 0:
+            raise ValueError('segment cursor cannot be negative')
+        return start_id, offset
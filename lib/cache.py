@@ -0,0 +1,112 @@
+# cache.py
+"""
+Contains a small in-process cache shared by the request handlers of an
+instance.
+"""
+
+import collections
+import threading
+import time
+
+class InstanceCache(object):
+    """
+    A thread safe key-value cache with optional expiration times.
+
+    Values live in the memory of a single instance, so they are only as fresh
+    as the writes made through this instance. Entries that can be changed by
+    other instances should be stored with a short time to live.
+
+    The cache holds at most max_entries entries. When it is full, expired
+    entries are dropped first, then the least recently stored ones.
+    """
+
+    def __init__(self, ttl=None, max_entries=1000):
+        """Initializes an empty cache.
+
+        :param ttl
+            The default time to live of an entry in seconds. Entries never
+            expire by default.
+        :param max_entries
+            The maximum number of entries in the cache.
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be a positive integer')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value stored for key, or default if the key is missing
+        or the entry has expired.
+
+        :param key
+            The key of the entry.
+        :param default
+            The value returned when there is no fresh entry for key.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Stores a value in the cache.
+
+        :param key
+            The key of the entry.
+        :param value
+            The value to store.
+        :param ttl
+            The time to live of the entry in seconds. Uses the default time to
+            live of the cache if not specified.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            # Re-inserting moves the key to the end of the eviction order.
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_entries:
+                self.evict(now)
+            self._entries[key] = (value, expires)
+
+    def evict(self, now):
+        """Makes room for one entry by dropping the expired entries, or the
+        least recently stored entry if none has expired. Must be called with
+        the lock held.
+
+        :param now
+            The current time in seconds since the epoch.
+        """
+        expired = [key for key, (_, expires) in self._entries.iteritems()
+                   if expires is not None and expires <= now]
+        for key in expired:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """Removes entries from the cache. Missing keys are ignored.
+
+        :param keys
+            The keys of the entries to remove.
+        """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes all the entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
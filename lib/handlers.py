@@ -19,21 +19,94 @@ The following handlers are defined:
 - EditBlogHandler
 - SaveBlogHandler
 - DeleteBlogHandler
+- WarmupHandler
+- RunTaskHandler
+- ArchiveHandler
+- BackfillHandler
 """
 
 import os
 import json
+import time
 import string
+import logging
 import functools
+import collections
 
 import jinja2
 import webapp2
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
+import profiling
+import tasks
 import util
+from identity import IdentityMap
 from models import User
 from models import Blog
 from models import Comment
+from models import CommentSegment
+from models import MonthBucket
+
+# Backfills an admin can run, by name. Each takes the app's task queue and
+# returns a json compatible result.
+BACKFILLS = {
+    'archive': lambda queue: tasks.rebuild_archive(),
+    'summaries': tasks.enqueue_summaries,
+    'comments': tasks.enqueue_compactions
+}
+
+# Keys and lifetimes of the entries kept in the instance cache. Other instances
+# can modify the same entities, so cached values expire quickly.
+FRONT_PAGE_KEY = 'front_page'
+FRONT_PAGE_TTL = 60
+BLOG_TTL = 60
+ARCHIVE_INDEX_KEY = 'archive_index'
+ARCHIVE_INDEX_TTL = 60
+
+# Number of blogs in a page of the archive.
+ARCHIVE_PAGE_SIZE = 10
+
+# Number of recent blogs inspected, and number of the most liked among those
+# cached, when an instance warms up.
+WARMUP_RECENT_BLOGS = 20
+WARMUP_HOT_BLOGS = 5
+
+def blog_cache_key(urlkey):
+    """Returns the key of a blog entry in the instance cache.
+
+    :param urlkey
+        The blog key in url safe format.
+    """
+    return 'blog:%s' % urlkey
+
+def parse_key(urlkey, kind=None):
+    """Decodes a key in url safe format.
+
+    :param urlkey
+        The key in url safe format.
+    :param kind
+        The kind the key must have. Any kind is accepted by default.
+    :return
+        The key, or None if urlkey is not a complete key of this app and
+        namespace, or not of the given kind.
+    """
+    if not urlkey or not isinstance(urlkey, basestring):
+        return None
+    try:
+        key = ndb.Key(urlsafe=urlkey)
+    except (TypeError, ValueError, ProtocolBufferDecodeError):
+        return None
+    if not key.id() or (kind and key.kind() != kind):
+        return None
+    # A key built here carries the app and namespace of this request.
+    local = ndb.Key(key.kind(), key.id())
+    if key.app() != local.app() or key.namespace() != local.namespace():
+        return None
+    return key
 
 def check_session(func):
     """Defines a decorator function that redirects to the login page if
@@ -64,12 +137,66 @@ def check_resource(func):
         if len(args) < 2:
             raise ValueError('Handler object not found')
         handler, urlkey = args[0], args[1]
-        handler.db_resource = ndb.Key(urlsafe=urlkey).get()
+        key = parse_key(urlkey)
+        if not key:
+            return handler.error(404)
+        handler.db_resource = handler.identity.get(key)
         if not handler.db_resource:
             return handler.error(404)
         return func(*args)
+    # Lets BaseHandler.dispatch fetch the resource along with the user.
+    wrapper.prefetch_resource = 'any'
+    return wrapper
+
+def check_cached_blog(func):
+    """Defines a decorator function like check_resource, but looks up the blog
+    in the instance cache before going to the datastore. Only suitable for
+    handlers that do not modify the blog.
+
+    Writes only clear the cache of the instance that made them, so the cached
+    blog is only served to logged out viewers. Session requests always read
+    the blog from the datastore, so that authors see their own edits, likes
+    and deletes.
+
+    :param func
+        The callable object to wrap.
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        if len(args) < 2:
+            raise ValueError('Handler object not found')
+        handler, urlkey = args[0], args[1]
+        cache_key = blog_cache_key(urlkey)
+        handler.db_resource = None
+        if not handler.is_session:
+            handler.db_resource = handler.cache.get(cache_key)
+        if not handler.db_resource:
+            key = parse_key(urlkey, Blog._get_kind())
+            if not key:
+                return handler.error(404)
+            handler.db_resource = handler.identity.get(key)
+            if not handler.db_resource:
+                return handler.error(404)
+            handler.cache.set(cache_key, handler.db_resource, BLOG_TTL)
+        return func(*args)
+    # Lets BaseHandler.dispatch fetch the blog along with the user when it is
+    # not served from the cache.
+    wrapper.prefetch_resource = 'cached_blog'
     return wrapper
 
+def prefetch_json_key(field):
+    """Defines a decorator function that lets BaseHandler.dispatch fetch the
+    entity whose url safe key is in a field of the json request body along
+    with the user. Must be applied below the check decorators.
+
+    :param field
+        The name of the field holding the key.
+    """
+    def decorator(func):
+        func.prefetch_json_key = field
+        return func
+    return decorator
+
 def check_ownership(func):
     """Defines a decorator function that enforces the ownership of a database
     resource.
@@ -116,8 +243,9 @@ class BaseHandler(webapp2.RequestHandler):
     """A wrapper to make request handlers less verbose to use."""
 
     def __init__(self, request, response):
-        """Overrides initialization of request and response objects to get
-        account info, and initializes session info with user name.
+        """Overrides initialization of request and response objects to queue
+        the lookup of the account named in the session cookies. The account
+        is loaded when the request is dispatched.
 
         :param request
             The request object
@@ -127,18 +255,149 @@ class BaseHandler(webapp2.RequestHandler):
         self.initialize(request, response)
         self.user = None
         self.db_resource = None
+        self.identity = IdentityMap()
+        self.session_key = None
         user_name = self.request.cookies.get('name')
-        hsh = self.request.cookies.get('secret')
-        if user_name and hsh:
-            user = User.get_by_id(user_name)
-            if user and user.pwd_hash == hsh:
+        if user_name and self.request.cookies.get('secret'):
+            self.session_key = ndb.Key(User, user_name)
+            self.identity.prefetch(self.session_key)
+
+    def dispatch(self):
+        """Loads the session account, together with the resource the handler
+        method is going to load, and dispatches the request. Reports the
+        lookups saved by the identity map afterwards.
+        """
+        method_name = self.request.method.lower().replace('-', '_')
+        key = self.resource_key(getattr(self, method_name, None))
+        if key:
+            self.identity.prefetch(key)
+        if self.session_key:
+            user = self.identity.get(self.session_key)
+            if user and user.pwd_hash == self.request.cookies.get('secret'):
                 self.user = user
+        try:
+            return super(BaseHandler, self).dispatch()
+        finally:
+            self.report_lookups()
+
+    def resource_key(self, method):
+        """Returns the key of the entity a handler method is going to load
+        with check_resource, check_cached_blog or prefetch_json_key, or None.
+        Invalid keys are left for the handler method to report.
+
+        :param method
+            The handler method.
+        """
+        prefetch = getattr(method, 'prefetch_resource', None)
+        if prefetch and self.request.route_args:
+            urlkey = self.request.route_args[0]
+            if prefetch != 'cached_blog':
+                return parse_key(urlkey)
+            # Session requests skip the cache, see check_cached_blog.
+            if (self.session_key
+                    or self.cache.get(blog_cache_key(urlkey)) is None):
+                return parse_key(urlkey, Blog._get_kind())
+            return None
+        field = getattr(method, 'prefetch_json_key', None)
+        if not field:
+            return None
+        try:
+            data = self.json_read()
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        key = parse_key(data.get(field))
+        # Archived comments are loaded through their segment.
+        if key and CommentSegment.holds(key):
+            return key.parent()
+        return key
+
+    def report_lookups(self):
+        """Logs the entity lookups and RPCs of the request, and records them
+        in the request's profile if it is being profiled.
+        """
+        identity = self.identity
+        logging.debug('identity map: %d entity lookups in %d RPCs, %d saved',
+                      identity.lookups, identity.rpcs, identity.saved)
+        profiling.record_count('identity_map', 'lookups', identity.lookups)
+        profiling.record_count('identity_map', 'rpcs', identity.rpcs)
+        profiling.record_count('identity_map', 'rpcs_saved', identity.saved)
 
     @property
     def is_session(self):
         """Return true if user is logged in, false otherwise."""
         return bool(self.user)
 
+    @property
+    def cache(self):
+        """The instance cache defined in the app's registry."""
+        cache = self.app.registry.get('cache')
+        if cache is None:
+            raise ValueError('cache must be defined in registry')
+        return cache
+
+    def invalidate_blog(self, urlkey=None):
+        """Drops the front page, and optionally a blog entry, from the instance
+        cache after a write.
+
+        :param urlkey
+            The key of the modified blog in url safe format.
+        """
+        keys = [FRONT_PAGE_KEY]
+        if urlkey:
+            keys.append(blog_cache_key(urlkey))
+        self.cache.delete(*keys)
+
+    def invalidate_archive(self):
+        """Drops the archive index from the instance cache after a blog is
+        created or deleted.
+        """
+        self.cache.delete(ARCHIVE_INDEX_KEY)
+
+    def enqueue(self, name, urlkey):
+        """Enqueues a background job for a blog using the task queue defined in
+        the app's registry. Failures are logged, not raised, since the job only
+        maintains derived data.
+
+        :param name
+            The name of the job.
+        :param urlkey
+            The blog key in url safe format.
+        """
+        queue = self.app.registry.get('tasks')
+        if queue is None:
+            raise ValueError('tasks must be defined in registry')
+        try:
+            return queue.add(name, urlkey)
+        except taskqueue.Error:
+            logging.exception('could not enqueue %s for %s', name, urlkey)
+            return False
+
+    def get_blogs(self):
+        """Returns all blog entries in reverse chronological date, excluding
+        blogs that have very recently been deleted but perhaps not reflected
+        in this snapshot of blog entries.
+
+        The list is kept in the instance cache for a short time and must not
+        be modified by callers.
+        """
+        blogs = self.cache.get(FRONT_PAGE_KEY)
+        changed = blogs is None
+        if changed:
+            blogs = Blog.query().order(-Blog.date).fetch()
+        else:
+            blogs = list(blogs)
+        deleted_blogs = self.app.registry.get('deleted_blogs')
+        while len(deleted_blogs):
+            blog = deleted_blogs.pop()
+            if blog in blogs:
+                blogs.remove(blog)
+                changed = True
+        if changed:
+            self.cache.set(FRONT_PAGE_KEY, blogs, FRONT_PAGE_TTL)
+        return blogs
+
     def write(self, strval):
         """Wrapper around self.response.out.write.
 
@@ -176,8 +435,12 @@ class BaseHandler(webapp2.RequestHandler):
         eng = self.app.registry.get('template_eng')
         if not eng:
             raise ValueError('template_eng must be defined in registry')
-        template = eng.get_template(template)
-        return template.render(context)
+        if not profiling.is_active():
+            return eng.get_template(template).render(context)
+        start = time.time()
+        result = eng.get_template(template).render(context)
+        profiling.record('template', template, time.time() - start)
+        return result
 
     def render(self, context, template):
         """Uses a context and template to render a page.
@@ -203,19 +466,6 @@ class MainHandler(BaseHandler):
         }
         return self.render(context, 'content.html')
 
-    def get_blogs(self):
-        """Returns all blog entries in reverse chronological date, excluding
-        blogs that have very recently been deleted but perhaps not reflected
-        in this snapshot of blog entries.
-        """
-        blogs = Blog.query().order(-Blog.date).fetch()
-        deleted_blogs = self.app.registry.get('deleted_blogs')
-        while len(deleted_blogs):
-            blog = deleted_blogs.pop()
-            if blog in blogs:
-                blogs.remove(blog)
-        return blogs
-
 
 class LoginHandler(BaseHandler):
     """Handle requests to login as a user of the blog site."""
@@ -350,6 +600,9 @@ class CreateCommentHandler(BaseHandler):
         except ndb.TransactionFailedError:
             # TODO: handle error as internal server error
             pass
+        else:
+            self.enqueue('refresh_summary', urlkey)
+            self.enqueue('compact_comments', urlkey)
         context = {'user_key': self.user.key, 'comment': comment}
         msg = self.render_str(context, 'comment.html')
         return self.json_write({'id': urlkey, 'comment': msg})
@@ -377,12 +630,16 @@ class CreateBlogHandler(BaseHandler):
         text = util.squeeze(text, string.whitespace)
         blog = Blog(user=self.user.key, title=title, text=text)
         try:
-            blog.put()
+            blog.insert()
         except ndb.TransactionFailedError:
             # TODO: Handle error
             return self.redirect('/')
         else:
-            return self.redirect('/blog/%s' % blog.key.urlsafe())
+            urlkey = blog.key.urlsafe()
+            self.invalidate_archive()
+            self.invalidate_blog()
+            self.enqueue('refresh_summary', urlkey)
+            return self.redirect('/blog/%s' % urlkey)
 
 
 class BlogFormHandler(BaseHandler):
@@ -433,6 +690,9 @@ class SaveBlogHandler(BaseHandler):
         except ndb.TransactionFailedError:
             # TODO: handle error as internal server error
             pass
+        else:
+            self.invalidate_blog(urlkey)
+            self.enqueue('refresh_summary', urlkey)
         finally:
             return self.redirect('/blog/%s' % urlkey)
 
@@ -444,21 +704,22 @@ class DeleteBlogHandler(BaseHandler):
     @check_resource
     @check_ownership
     def get(self, urlkey):
-        """Deletes a blog entry and redirects to the main page.
+        """Deletes a blog entry and redirects to the main page. Its comments
+        are deleted by a background job.
 
         :param urlkey
             The blog key in url safe format.
         """
         blog = self.db_resource
-        query = Comment.query(Comment.blog == blog.key)
-        comment_keys = [comment.key for comment in query.fetch()]
         try:
-            blog.key.delete()
-            ndb.delete_multi(comment_keys)
+            blog.remove()
         except ndb.TransactionFailedError:
             # TODO: handle error as internal server error
             pass
         else:
+            self.invalidate_archive()
+            self.invalidate_blog(urlkey)
+            self.enqueue('delete_blog_data', urlkey)
             self.app.registry.get('deleted_blogs').append(blog)
         finally:
             return self.redirect('/')
@@ -467,7 +728,7 @@ class DeleteBlogHandler(BaseHandler):
 class ViewBlogHandler(BaseHandler):
     """Handlers requests to view a blog entry."""
 
-    @check_resource
+    @check_cached_blog
     def get(self, urlkey):
         """Renders a blog entry.
 
@@ -475,8 +736,7 @@ class ViewBlogHandler(BaseHandler):
             The blog key in url safe format.
         """
         blog = self.db_resource
-        comments = Comment.query(
-            Comment.blog == blog.key).order(Comment.date).fetch()
+        comments = Comment.for_blog(blog.key)
         context = self.get_context(blog, self.is_session, comments)
         # check if user likes blog
         if self.is_session:
@@ -511,17 +771,19 @@ class EditCommentHandler(BaseHandler):
     """Handles the request to edit a blog comment."""
 
     @check_session
+    @prefetch_json_key('id')
     def post(self):
         """Saves or deletes the comment and redirects to blog post."""
         data = self.json_read()
-        comment = ndb.Key(urlsafe=data['id']).get()
+        key = parse_key(data['id'], Comment._get_kind())
+        comment = Comment.lookup(key, self.identity.get) if key else None
         if not comment:
             return self.error(404)
         if not comment.is_author(self.user.key):
             return self.redirect('/')
         comment.text = data['text'].strip()
         try:
-            comment.put()
+            comment.save()
         except ndb.TransactionFailedError:
             # TODO: handle error as internal server error
             pass
@@ -535,19 +797,22 @@ class DeleteCommentHandler(BaseHandler):
     """Responds to a request to delete a comment in a blog."""
 
     @check_session
+    @prefetch_json_key('id')
     def post(self):
         """Deletes a comment from the DB and responds to request."""
         data = self.json_read()
         comment_id = data['id']
-        comment = ndb.Key(urlsafe=comment_id).get()
+        key = parse_key(comment_id, Comment._get_kind())
+        comment = Comment.lookup(key, self.identity.get) if key else None
         if not comment:
             return self.error(404)
         if not comment.is_author(self.user.key):
             return self.redirect('/')
         data['id'] = None
         try:
-            comment.key.delete()
+            comment.remove()
             data['id'] = comment_id
+            self.enqueue('refresh_summary', comment.blog.urlsafe())
         except ndb.TransactionFailedError:
             # TODO: handle error as internal server error
             pass
@@ -572,6 +837,8 @@ class LikeBlogHandler(BaseHandler):
             blog.likes.remove(self.user.key)
             try:
                 blog.put()
+                self.invalidate_blog(urlkey)
+                self.enqueue('refresh_summary', urlkey)
                 data['remove'] = True
             except ndb.TransactionFailedError:
                 # TODO: handle error as internal server error
@@ -582,8 +849,138 @@ class LikeBlogHandler(BaseHandler):
         blog.likes.append(self.user.key)
         try:
             blog.put()
+            self.invalidate_blog(urlkey)
+            self.enqueue('refresh_summary', urlkey)
             data['add'] = True
         except ndb.TransactionFailedError:
             # TODO: handle error as internal server error
             pass
         return self.json_write(data)
+
+
+class WarmupHandler(BaseHandler):
+    """Handles the warmup request App Engine sends to a new instance before it
+    receives live traffic. Restricted to admins in app.yaml, which App Engine's
+    own warmup requests pass."""
+
+    def get(self):
+        """Primes the template engine, the datastore connection and the
+        instance cache, and records how long each phase took in milliseconds.
+        """
+        phases = [
+            ('templates', self.load_templates),
+            ('datastore', self.open_datastore),
+            ('front_page', self.load_front_page)
+        ]
+        timings = collections.OrderedDict()
+        for name, phase in phases:
+            start = time.time()
+            phase()
+            timings[name] = round((time.time() - start) * 1000, 3)
+        self.app.registry['warmup_timings'] = timings
+        logging.info('warmup timings (ms): %s', json.dumps(timings))
+        return self.json_write(timings)
+
+    def load_templates(self):
+        """Loads and compiles every template known to the template engine."""
+        eng = self.app.registry.get('template_eng')
+        if not eng:
+            raise ValueError('template_eng must be defined in registry')
+        for name in eng.list_templates():
+            eng.get_template(name)
+
+    def open_datastore(self):
+        """Issues a cheap query to open the datastore connection."""
+        Blog.query().fetch(1, keys_only=True)
+
+    def load_front_page(self):
+        """Fetches the front page and caches the most liked recent blogs."""
+        self.cache.delete(FRONT_PAGE_KEY)
+        recent = self.get_blogs()[:WARMUP_RECENT_BLOGS]
+        hot = sorted(recent, key=lambda blog: len(blog.likes), reverse=True)
+        for blog in hot[:WARMUP_HOT_BLOGS]:
+            self.cache.set(blog_cache_key(blog.key.urlsafe()), blog, BLOG_TTL)
+
+
+class RunTaskHandler(BaseHandler):
+    """Runs a background job pushed by the task queue."""
+
+    def post(self, name):
+        """Runs the job for the blog given in the request.
+
+        Errors propagate so that the task queue retries the task with backoff.
+        Unknown jobs are dropped, since retrying them cannot succeed.
+
+        :param name
+            The name of the job.
+        """
+        # App Engine strips this header from requests not made by the queue.
+        if 'X-AppEngine-QueueName' not in self.request.headers:
+            return self.error(403)
+        if name not in tasks.JOBS:
+            logging.error('dropping task for unknown job %s', name)
+            return
+        tasks.run_job(name, self.request.get('key'))
+
+
+class ArchiveHandler(BaseHandler):
+    """Handles requests to browse blogs by month."""
+
+    def get(self, year=None, month=None):
+        """Renders the archive index, and the blogs of a month if one is given.
+
+        :param year
+            The year of the month.
+        :param month
+            The month, from 1 to 12.
+        """
+        context = {
+            'loggedin': self.is_session,
+            'buckets': self.get_buckets()
+        }
+        if year:
+            try:
+                start, end = util.month_range(int(year), int(month))
+                cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+            except (ValueError, datastore_errors.BadValueError):
+                return self.error(404)
+            query = Blog.query(Blog.date >= start, Blog.date < end)
+            try:
+                blogs, next_cursor, more = query.order(-Blog.date).fetch_page(
+                    ARCHIVE_PAGE_SIZE, start_cursor=cursor)
+            except datastore_errors.BadRequestError:
+                # The cursor belongs to another query, e.g. another month.
+                return self.error(404)
+            context['month_name'] = start.strftime('%B %Y')
+            context['blog_titles'] = blogs
+            if more and next_cursor:
+                context['next_cursor'] = next_cursor.urlsafe()
+        return self.render(context, 'archive.html')
+
+    def get_buckets(self):
+        """Returns the months with blogs in reverse chronological order. The
+        list is kept in the instance cache for a short time.
+        """
+        buckets = self.cache.get(ARCHIVE_INDEX_KEY)
+        if buckets is None:
+            buckets = [bucket for bucket in
+                       MonthBucket.query().order(-MonthBucket.start).fetch()
+                       if bucket.count]
+            self.cache.set(ARCHIVE_INDEX_KEY, buckets, ARCHIVE_INDEX_TTL)
+        return buckets
+
+
+class BackfillHandler(BaseHandler):
+    """Runs a backfill of derived data, by hand or from cron.yaml. Restricted
+    to admins in app.yaml."""
+
+    def get(self, name):
+        """Runs the named backfill and writes its result.
+
+        :param name
+            The name of the backfill.
+        """
+        backfill = BACKFILLS.get(name)
+        if not backfill:
+            return self.error(404)
+        return self.json_write(backfill(self.app.registry.get('tasks')))
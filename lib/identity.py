@@ -0,0 +1,59 @@
+# identity.py
+"""
+Contains a request scoped identity map for datastore entities.
+"""
+
+from google.appengine.ext import ndb
+
+class IdentityMap(object):
+    """
+    Loads entities by key at most once per request.
+
+    Keys known early in a request are queued with prefetch, and are fetched
+    together with the next lookup in a single get_multi RPC. Repeated lookups
+    of a key return the same object.
+    """
+
+    def __init__(self):
+        self.entities = {}
+        self.pending = set()
+        self.lookups = 0
+        self.rpcs = 0
+
+    @property
+    def saved(self):
+        """The number of lookups served without an RPC of their own."""
+        return max(self.lookups - self.rpcs, 0)
+
+    def prefetch(self, *keys):
+        """Queues keys to be fetched with the next lookup.
+
+        :param keys
+            The keys of the entities.
+        """
+        for key in keys:
+            if key not in self.entities:
+                self.pending.add(key)
+
+    def get(self, key):
+        """Returns the entity with the given key, or None if it does not exist.
+        Fetches the key along with every queued key if it is not loaded yet.
+
+        :param key
+            The key of the entity.
+        """
+        self.lookups += 1
+        if key not in self.entities:
+            self.pending.add(key)
+            self.flush()
+        return self.entities[key]
+
+    def flush(self):
+        """Fetches the queued keys in one RPC."""
+        if not self.pending:
+            return
+        keys = list(self.pending)
+        self.pending.clear()
+        self.rpcs += 1
+        for key, entity in zip(keys, ndb.get_multi(keys)):
+            self.entities[key] = entity
@@ -4,8 +4,12 @@ Contains definitions for the following database object models:
 - Account
 - Blog
 - BlogComment
+- BlogSummary
+- MonthBucket
+- CommentSegment
 """
 
+import json
 from datetime import datetime
 from datetime import timedelta
 
@@ -59,6 +63,33 @@ class Blog(ndb.Model):
         """Returns true if user is the author of this blog."""
         return self.user == user
 
+    @ndb.transactional(xg=True)
+    def insert(self):
+        """Stores a new blog and counts it in the archive in one
+        transaction.
+
+        :return
+            The key of the blog.
+        """
+        key = self.put()
+        MonthBucket.adjust(self.date, 1)
+        return key
+
+    @ndb.transactional(xg=True)
+    def remove(self):
+        """Deletes the blog and removes it from the archive count in one
+        transaction.
+
+        :return
+            False if the blog was already deleted, true otherwise.
+        """
+        blog = self.key.get()
+        if not blog:
+            return False
+        self.key.delete()
+        MonthBucket.adjust(blog.date, -1)
+        return True
+
     @property
     def lines(self):
         """Splits the blog text into lines.
@@ -125,6 +156,74 @@ class Comment(ndb.Model):
         """Returns true user is the author of this comment."""
         return self.user == user
 
+    @property
+    def is_archived(self):
+        """True if this comment is stored in a CommentSegment."""
+        return CommentSegment.holds(self.key)
+
+    @classmethod
+    def lookup(cls, key, get=None):
+        """Returns the comment with the given key, whether it is archived or
+        not, or None if there is no such comment.
+
+        :param key
+            The key of the comment.
+        :param get
+            The function used to load an entity by key. Uses Key.get by
+            default.
+        """
+        if CommentSegment.holds(key):
+            return CommentSegment.get_comment(key, get)
+        return get(key) if get else key.get()
+
+    @classmethod
+    def for_blog(cls, blog_key):
+        """Returns all the comments on a blog in chronological order, merging
+        the archived comments with the ones that have not been archived yet.
+
+        :param blog_key
+            The key of the blog.
+        """
+        comments = CommentSegment.get_comments(blog_key)
+        archived = set(comment.key.id() for comment in comments)
+        query = cls.query(cls.blog == blog_key).order(cls.date)
+        # The query is eventually consistent, and can still return comments
+        # that were just archived.
+        return comments + [comment for comment in query.fetch()
+                           if comment.key.id() not in archived]
+
+    @ndb.transactional(xg=True)
+    def save(self):
+        """Stores the comment, in its segment if it is archived. A comment
+        loaded before it was archived is stored in its segment, and takes the
+        key of its archived copy.
+
+        :return
+            The key of the comment, or None if it no longer exists.
+        """
+        if not self.is_archived:
+            if self.key.get():
+                return self.put()
+            archived = CommentSegment.find(self.blog, self.key.id())
+            if not archived:
+                return None
+            self.key = archived.key
+        return CommentSegment.put_comment(self)
+
+    @ndb.transactional(xg=True)
+    def remove(self):
+        """Deletes the comment, from its segment if it is archived, including a
+        comment loaded before it was archived.
+        """
+        if not self.is_archived:
+            if self.key.get():
+                return self.key.delete()
+            archived = CommentSegment.find(self.blog, self.key.id())
+            if not archived:
+                return
+            self.key = archived.key
+        return CommentSegment.delete_comment(self.key)
+
     def get_timedelta(self):
         """Returns a string representing the timedelta since the comment was
         creted.
@@ -159,3 +258,379 @@ class Comment(ndb.Model):
         elif delta.seconds == 1:
             return "1 second ago"
         return "%d seconds ago" % delta.seconds
+
+
+class BlogSummary(ndb.Model):
+    """
+    Data derived from a blog entry, kept up to date by background jobs. Shares
+    the id of the blog it summarizes.
+
+    Fields:
+        blog: The key property of the summarized blog.
+        user: The blog author.
+        title: The blog title.
+        date: The date-time the blog was created.
+        tease: The tease of the blog.
+        like_count: The number of users who have liked the blog.
+        comment_count: The number of comments on the blog.
+        updated: The date-time the summary was last computed.
+    """
+    blog = ndb.KeyProperty(kind=Blog, required=True)
+    user = ndb.KeyProperty(kind=User, required=True)
+    title = ndb.StringProperty(required=True)
+    date = ndb.DateTimeProperty(required=True)
+    tease = ndb.TextProperty()
+    like_count = ndb.IntegerProperty(default=0)
+    comment_count = ndb.IntegerProperty(default=0)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def key_for(cls, blog_key):
+        """Returns the key of the summary of a blog.
+
+        :param blog_key
+            The key of the blog.
+        """
+        return ndb.Key(cls, blog_key.id())
+
+    @classmethod
+    def from_blog(cls, blog, comment_count):
+        """Creates the summary of a blog.
+
+        :param blog
+            The blog entry model.
+        :param comment_count
+            The number of comments on the blog.
+        """
+        return cls(
+            key=cls.key_for(blog.key),
+            blog=blog.key,
+            user=blog.user,
+            title=blog.title,
+            date=blog.date,
+            tease=blog.tease,
+            like_count=len(blog.likes),
+            comment_count=comment_count)
+
+
+class MonthBucket(ndb.Model):
+    """
+    The number of blogs posted in a month, updated as blogs are created and
+    deleted so that the archive never has to count blogs.
+
+    Fields:
+        year: The year of the month.
+        month: The month, from 1 to 12.
+        start: The date-time the month starts.
+        count: The number of blogs posted in the month.
+    """
+    year = ndb.IntegerProperty(required=True)
+    month = ndb.IntegerProperty(required=True)
+    start = ndb.DateTimeProperty(required=True)
+    count = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    def key_for(cls, date):
+        """Returns the key of the bucket for the month of a date.
+
+        :param date
+            A date or date-time.
+        """
+        return ndb.Key(cls, '%04d-%02d' % (date.year, date.month))
+
+    @classmethod
+    @ndb.transactional
+    def adjust(cls, date, delta):
+        """Adds delta to the count of the bucket for the month of a date,
+        creating the bucket if needed.
+
+        :param date
+            A date or date-time.
+        :param delta
+            The number of blogs added, or removed if negative.
+        :return
+            The updated bucket.
+        """
+        key = cls.key_for(date)
+        bucket = key.get()
+        if not bucket:
+            bucket = cls(key=key, year=date.year, month=date.month,
+                         start=datetime(date.year, date.month, 1))
+        bucket.count = max(bucket.count + delta, 0)
+        bucket.put()
+        return bucket
+
+
+class CommentSegment(ndb.Model):
+    """
+    A compressed batch of old comments on a blog, moved out of the Comment kind
+    so that reading a blog does not read one entity per old comment. Segments
+    are children of their blog and numbered from 1 in chronological order.
+
+    Archived comments keep their original id, but their key has the segment as
+    parent.
+
+    Fields:
+        start: The date-time of the oldest comment in the segment.
+        end: The date-time of the newest comment in the segment.
+        count: The number of comments in the segment.
+        data: The comments as a compressed json list.
+    """
+    # Maximum size in bytes of the serialized comments of a segment, before
+    # compression. Keeps segments well under the 1 MB entity limit.
+    MAX_BYTES = 512 * 1024
+    DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+    start = ndb.DateTimeProperty()
+    end = ndb.DateTimeProperty()
+    count = ndb.IntegerProperty(default=0)
+    data = ndb.BlobProperty(compressed=True)
+
+    @property
+    def entries(self):
+        """The comments in the segment as a list of dictionaries."""
+        return json.loads(self.data) if self.data else []
+
+    @entries.setter
+    def entries(self, entries):
+        self.data = self.serialize(entries)
+        self.count = len(entries)
+        self.start = self.parse_date(entries[0]['date']) if entries else None
+        self.end = self.parse_date(entries[-1]['date']) if entries else None
+
+    @classmethod
+    def parse_date(cls, value):
+        """Converts a date-time stored in an entry back to a datetime."""
+        return datetime.strptime(value, cls.DATE_FORMAT)
+
+    @staticmethod
+    def serialize(entries):
+        """Converts a list of entries to compact json."""
+        return json.dumps(entries, separators=(',', ':'))
+
+    @classmethod
+    def holds(cls, key):
+        """Returns true if key is the key of an archived comment.
+
+        :param key
+            The key of a comment.
+        """
+        parent = key.parent()
+        return parent is not None and parent.kind() == cls._get_kind()
+
+    def to_comment(self, entry):
+        """Converts an entry to an unsaved Comment keyed under this segment.
+
+        :param entry
+            A dictionary representing a comment.
+        """
+        return Comment(
+            key=ndb.Key(Comment, entry['id'], parent=self.key),
+            blog=self.key.parent(),
+            user=ndb.Key(User, entry['user']),
+            date=self.parse_date(entry['date']),
+            text=entry['text'])
+
+    @staticmethod
+    def to_entry(comment):
+        """Converts a comment to an entry.
+
+        :param comment
+            The Comment model.
+        """
+        return {
+            'id': comment.key.id(),
+            'user': comment.user.id(),
+            'date': comment.date.strftime(CommentSegment.DATE_FORMAT),
+            'text': comment.text
+        }
+
+    @classmethod
+    def for_blog(cls, blog_key):
+        """Returns the segments of a blog in chronological order.
+
+        :param blog_key
+            The key of the blog.
+        """
+        segments = cls.query(ancestor=blog_key).fetch()
+        return sorted(segments, key=lambda segment: segment.key.id())
+
+    @classmethod
+    def get_comments(cls, blog_key):
+        """Returns the archived comments on a blog in chronological order.
+
+        :param blog_key
+            The key of the blog.
+        """
+        return [segment.to_comment(entry)
+                for segment in cls.for_blog(blog_key)
+                for entry in segment.entries]
+
+    @classmethod
+    def comment_ids(cls, blog_key):
+        """Returns the original ids of the archived comments on a blog.
+
+        :param blog_key
+            The key of the blog.
+        """
+        return set(entry['id']
+                   for segment in cls.for_blog(blog_key)
+                   for entry in segment.entries)
+
+    @classmethod
+    def get_page(cls, blog_key, start_id, offset, limit):
+        """Returns a page of the archived comments on a blog in chronological
+        order.
+
+        :param blog_key
+            The key of the blog.
+        :param start_id
+            The id of the segment holding the first comment of the page. Gaps
+            left by deleted segments are skipped.
+        :param offset
+            The index of the first comment of the page in its segment.
+        :param limit
+            The maximum number of comments in the page.
+        :return
+            A tuple with the comments, and the segment id and offset where the
+            next page starts, or None if the archived comments are exhausted.
+        """
+        keys = cls.query(ancestor=blog_key).fetch(keys_only=True)
+        ids = sorted(key.id() for key in keys if key.id() >= start_id)
+        if ids and ids[0] != start_id:
+            offset = 0
+        comments = []
+        for segment_id in ids:
+            segment = ndb.Key(cls, segment_id, parent=blog_key).get()
+            entries = segment.entries[offset:] if segment else []
+            room = limit - len(comments)
+            comments.extend(segment.to_comment(entry)
+                            for entry in entries[:room])
+            if len(entries) > room:
+                return comments, (segment_id, offset + room)
+            offset = 0
+            if len(comments) == limit:
+                return comments, (segment_id + 1, 0)
+        return comments, None
+
+    @classmethod
+    def find(cls, blog_key, comment_id):
+        """Returns the archived copy of a comment, or None if the comment is
+        not archived.
+
+        :param blog_key
+            The key of the blog.
+        :param comment_id
+            The original id of the comment.
+        """
+        for segment in cls.for_blog(blog_key):
+            for entry in segment.entries:
+                if entry['id'] == comment_id:
+                    return segment.to_comment(entry)
+        return None
+
+    @classmethod
+    def get_comment(cls, key, get=None):
+        """Returns an archived comment, or None if it does not exist.
+
+        :param key
+            The key of the comment.
+        :param get
+            The function used to load the segment by key. Uses Key.get by
+            default.
+        """
+        segment = get(key.parent()) if get else key.parent().get()
+        if not segment:
+            return None
+        for entry in segment.entries:
+            if entry['id'] == key.id():
+                return segment.to_comment(entry)
+        return None
+
+    @classmethod
+    @ndb.transactional
+    def put_comment(cls, comment):
+        """Replaces an archived comment with a new version.
+
+        :param comment
+            The Comment model, keyed under its segment.
+        """
+        segment = comment.key.parent().get()
+        if not segment:
+            raise ValueError('segment of archived comment not found')
+        entries = segment.entries
+        for index, entry in enumerate(entries):
+            if entry['id'] == comment.key.id():
+                entries[index] = cls.to_entry(comment)
+                break
+        else:
+            raise ValueError('archived comment not found')
+        segment.entries = entries
+        segment.put()
+        return comment.key
+
+    @classmethod
+    @ndb.transactional
+    def delete_comment(cls, key):
+        """Removes an archived comment, deleting its segment if it is left
+        empty.
+
+        :param key
+            The key of the comment.
+        """
+        segment = key.parent().get()
+        if not segment:
+            return
+        entries = [entry for entry in segment.entries
+                   if entry['id'] != key.id()]
+        if entries:
+            segment.entries = entries
+            segment.put()
+        else:
+            segment.key.delete()
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def archive(cls, blog_key, comment_keys):
+        """Moves comments into the newest segment of a blog, starting new
+        segments when their serialized size would exceed MAX_BYTES. The
+        comments must be older than any comment left unarchived, and the
+        number of keys must keep the transaction within the cross-group limit.
+
+        :param blog_key
+            The key of the blog.
+        :param comment_keys
+            The keys of the comments in chronological order.
+        :return
+            The number of comments archived.
+        """
+        comments = [comment for comment in ndb.get_multi(comment_keys)
+                    if comment]
+        if not comments:
+            return 0
+        keys = cls.query(ancestor=blog_key).fetch(keys_only=True)
+        last_id = max([key.id() for key in keys] or [0])
+        segment = None
+        if last_id:
+            segment = ndb.Key(cls, last_id, parent=blog_key).get()
+        if not segment:
+            segment = cls(id=last_id + 1, parent=blog_key)
+        segments = [segment]
+        entries = segment.entries
+        size = len(cls.serialize(entries))
+        for comment in comments:
+            entry = cls.to_entry(comment)
+            # One more byte for the separating comma.
+            entry_size = len(cls.serialize(entry)) + 1
+            if entries and size + entry_size > cls.MAX_BYTES:
+                segment.entries = entries
+                segment = cls(id=segment.key.id() + 1, parent=blog_key)
+                segments.append(segment)
+                entries = []
+                size = len(cls.serialize(entries))
+            entries.append(entry)
+            size += entry_size
+        segment.entries = entries
+        ndb.put_multi(segments)
+        ndb.delete_multi([comment.key for comment in comments])
+        return len(comments)
@@ -0,0 +1,233 @@
+# profiling.py
+"""
+Contains an on-demand profiler for request dispatch.
+
+A request is profiled when an admin sends the X-Profile header or the profile
+query parameter, or when it is picked by sampling. Profiled requests run under
+cProfile, and their datastore RPCs and template renders are timed separately.
+Each profile is written in pstats format, which flame graph tools such as
+flameprof and snakeviz read, next to a json file with the request info and the
+tagged timings. Profiles go to a fixed number of slots on disk, the oldest
+being overwritten first.
+
+Profiles are written to the local filesystem, which the python27 standard
+runtime does not allow, so profiling only works in dev_appserver. In
+production every save fails and is logged.
+
+Requests that are not profiled only pay for the sampling and flag checks.
+"""
+
+import cProfile
+import collections
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAM = 'profile'
+
+# State of the request being profiled by the current thread, if any.
+_state = threading.local()
+
+def is_active():
+    """Returns true if the current request is being profiled."""
+    return getattr(_state, 'tags', None) is not None
+
+def record(kind, name, elapsed):
+    """Records the time spent in a tagged operation of a profiled request. Does
+    nothing if the current request is not being profiled.
+
+    :param kind
+        The kind of operation, e.g., datastore or template.
+    :param name
+        The name of the operation, e.g., the RPC method or template name.
+    :param elapsed
+        The time spent in seconds.
+    """
+    tags = getattr(_state, 'tags', None)
+    if tags is None:
+        return
+    entry = tags[kind][name]
+    entry['count'] += 1
+    entry['seconds'] += elapsed
+
+def record_count(kind, name, count):
+    """Adds to a counter of a profiled request. Does nothing if the current
+    request is not being profiled.
+
+    :param kind
+        The kind of counter, e.g., identity_map.
+    :param name
+        The name of the counter.
+    :param count
+        The amount to add.
+    """
+    tags = getattr(_state, 'tags', None)
+    if tags is None:
+        return
+    tags[kind][name]['count'] += count
+
+def datastore_pre_hook(service, call, request, response, rpc):
+    """Notes the start time of a datastore RPC made by a profiled request."""
+    if is_active():
+        _state.rpcs[id(rpc)] = time.time()
+
+def datastore_post_hook(service, call, request, response, rpc):
+    """Records the duration of a datastore RPC made by a profiled request."""
+    if is_active():
+        start = _state.rpcs.pop(id(rpc), None)
+        if start is not None:
+            record('datastore', call, time.time() - start)
+
+
+class Profiler(object):
+    """Profiles the dispatch of selected requests."""
+
+    def __init__(self, directory=None, capacity=32, sample_rate=0.0):
+        """Initializes the profiler.
+
+        :param directory
+            The directory where profiles are written. Uses a directory in the
+            system's temporary directory by default.
+        :param capacity
+            The number of profiles kept on disk.
+        :param sample_rate
+            The fraction of requests profiled without being asked to.
+        """
+        if capacity < 1:
+            raise ValueError('capacity must be a positive integer')
+        if not directory:
+            directory = os.path.join(tempfile.gettempdir(), 'omblog-profiles')
+        self.directory = directory
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+
+    def should_profile(self, request):
+        """Returns true if the request should be profiled.
+
+        :param request
+            The request object.
+        """
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        if (PROFILE_HEADER in request.headers
+                or PROFILE_PARAM in request.GET):
+            return users.is_current_user_admin()
+        return False
+
+    def dispatch(self, router, request, response):
+        """Dispatches a request with the router's default dispatcher, profiling
+        it if needed.
+
+        :param router
+            The app's router.
+        :param request
+            The request object.
+        :param response
+            The response object.
+        """
+        if not self.should_profile(request):
+            return webapp2.Router.default_dispatcher(router, request, response)
+        _state.tags = collections.defaultdict(
+            lambda: collections.defaultdict(
+                lambda: {'count': 0, 'seconds': 0.0}))
+        _state.rpcs = {}
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(
+                webapp2.Router.default_dispatcher, router, request, response)
+        finally:
+            elapsed = time.time() - start
+            tags = _state.tags
+            _state.tags = None
+            _state.rpcs = None
+            self.save(profile, request, elapsed, tags)
+
+    def slot_path(self, slot):
+        """Returns the path of a slot, without extension.
+
+        :param slot
+            The index of the slot.
+        """
+        return os.path.join(self.directory, 'profile-%03d' % slot)
+
+    def next_slot(self):
+        """Returns the index of the first unused slot, or of the slot holding
+        the oldest profile if all are used. Reading the slots from disk keeps
+        the newest profiles across restarts and processes.
+        """
+        oldest, oldest_time = 0, None
+        for slot in range(self.capacity):
+            try:
+                mtime = os.path.getmtime(self.slot_path(slot) + '.pstats')
+            except OSError:
+                return slot
+            if oldest_time is None or mtime < oldest_time:
+                oldest, oldest_time = slot, mtime
+        return oldest
+
+    def save(self, profile, request, elapsed, tags):
+        """Writes a profile to the next slot on disk. Errors are logged, not
+        raised, so profiling never fails a request.
+
+        :param profile
+            The cProfile.Profile of the request.
+        :param request
+            The request object.
+        :param elapsed
+            The time spent dispatching the request in seconds.
+        :param tags
+            The tagged timings recorded during the request.
+        """
+        info = {
+            'method': request.method,
+            'path': request.path_qs,
+            'time': time.time() - elapsed,
+            'seconds': elapsed,
+            'tags': tags
+        }
+        base = self.directory
+        try:
+            # Choosing and writing a slot under the lock keeps threads of
+            # this process from picking the same slot.
+            with self._lock:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                base = self.slot_path(self.next_slot())
+                profile.dump_stats(base + '.pstats')
+                with open(base + '.json', 'w') as out:
+                    json.dump(info, out, indent=2)
+        except (IOError, OSError):
+            logging.exception('could not write profile to %s', base)
+        else:
+            logging.info('profiled %s %s in %.3fs: %s.pstats',
+                         request.method, request.path_qs, elapsed, base)
+
+
+def install(app, profiler):
+    """Makes an app dispatch requests through a profiler, and registers the
+    hooks that time datastore RPCs.
+
+    :param app
+        The webapp2.WSGIApplication.
+    :param profiler
+        The Profiler.
+    """
+    def dispatcher(router, request, response):
+        return profiler.dispatch(router, request, response)
+    app.router.set_dispatcher(dispatcher)
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append(
+        'profiling', datastore_pre_hook, 'datastore_v3')
+    apiproxy.GetPostCallHooks().Append(
+        'profiling', datastore_post_hook, 'datastore_v3')
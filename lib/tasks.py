@@ -0,0 +1,366 @@
+# tasks.py
+"""
+Contains the background jobs that maintain data derived from blog entries, and
+the queues used to run them.
+
+Jobs are idempotent: each one recomputes its result from the current state of
+the datastore, so running a job twice, or late, is harmless. Jobs for the same
+blog that are enqueued within the same coalescing window are merged into one.
+
+The following jobs are defined:
+- refresh_summary
+- delete_blog_data
+- compact_comments
+
+It also contains backfills that rebuild derived data for every blog.
+"""
+
+import collections
+import logging
+import os
+import Queue
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Blog
+from models import BlogSummary
+from models import Comment
+from models import CommentSegment
+from models import MonthBucket
+
+# Jobs enqueued for the same blog within this many seconds are coalesced. Each
+# job runs SETTLE_DELAY seconds after the end of its window, so that queries,
+# which are eventually consistent, see every write made during the window.
+COALESCE_WINDOW = 5
+SETTLE_DELAY = 10
+
+# Name of the push queue, defined in queue.yaml, used for derived data.
+QUEUE_NAME = 'derived'
+
+# URL prefix of the handler that runs jobs pushed by the task queue.
+TASK_URL = '/_tasks'
+
+# Batch size used when deleting entities in a job.
+BATCH_SIZE = 500
+
+# Comments older than this are compacted into segments. Configured in days with
+# the COMMENT_ARCHIVE_DAYS environment variable.
+COMMENT_ARCHIVE_AGE = timedelta(
+    days=int(os.environ.get('COMMENT_ARCHIVE_DAYS', 30)))
+
+# Number of comments moved per transaction. Each comment is its own entity
+# group, and cross-group transactions are limited to 25 groups.
+COMPACT_BATCH_SIZE = 20
+
+JOBS = {}
+
+def job(name):
+    """Defines a decorator function that registers a job under a name.
+
+    :param name
+        The name of the job. Must be usable in a task name.
+    """
+    def register(func):
+        JOBS[name] = func
+        return func
+    return register
+
+def run_job(name, urlkey):
+    """Runs a registered job.
+
+    :param name
+        The name of the job.
+    :param urlkey
+        The blog key in url safe format.
+    """
+    func = JOBS.get(name)
+    if not func:
+        raise ValueError('%s is not a registered job' % name)
+    return func(urlkey)
+
+def window_countdown(now=None):
+    """Returns the number of seconds left in the current coalescing window and
+    the index of the window.
+
+    :param now
+        The current time in seconds since the epoch.
+    """
+    if now is None:
+        now = time.time()
+    index = int(now // COALESCE_WINDOW)
+    return (index + 1) * COALESCE_WINDOW - now, index
+
+
+@job('refresh_summary')
+def refresh_summary(urlkey):
+    """Recomputes the summary of a blog, or removes it if the blog is gone.
+
+    :param urlkey
+        The blog key in url safe format.
+    """
+    blog_key = ndb.Key(urlsafe=urlkey)
+    summary_key = BlogSummary.key_for(blog_key)
+    blog = blog_key.get()
+    if not blog:
+        summary_key.delete()
+        return
+    # Comments keep their id when they are archived, and the query can still
+    # return comments that were just archived, so distinct ids are counted.
+    ids = CommentSegment.comment_ids(blog_key)
+    query = Comment.query(Comment.blog == blog_key)
+    ids.update(key.id() for key in query.iter(keys_only=True))
+    BlogSummary.from_blog(blog, len(ids)).put()
+
+
+@job('delete_blog_data')
+def delete_blog_data(urlkey):
+    """Deletes the comments and summary of a deleted blog.
+
+    :param urlkey
+        The blog key in url safe format.
+    """
+    blog_key = ndb.Key(urlsafe=urlkey)
+    if blog_key.get():
+        # The blog is still around, e.g. the delete failed. Nothing to do.
+        return
+    query = Comment.query(Comment.blog == blog_key)
+    keys = query.fetch(BATCH_SIZE, keys_only=True)
+    while keys:
+        ndb.delete_multi(keys)
+        keys = query.fetch(BATCH_SIZE, keys_only=True)
+    ndb.delete_multi(
+        CommentSegment.query(ancestor=blog_key).fetch(keys_only=True))
+    BlogSummary.key_for(blog_key).delete()
+
+
+@job('compact_comments')
+def compact_comments(urlkey):
+    """Moves the comments on a blog older than COMMENT_ARCHIVE_AGE into
+    comment segments.
+
+    :param urlkey
+        The blog key in url safe format.
+    """
+    blog_key = ndb.Key(urlsafe=urlkey)
+    cutoff = datetime.now() - COMMENT_ARCHIVE_AGE
+    query = Comment.query(
+        Comment.blog == blog_key, Comment.date < cutoff).order(Comment.date)
+    keys = query.fetch(COMPACT_BATCH_SIZE, keys_only=True)
+    # Stop when a batch only holds comments already moved, which the query can
+    # still return until its index catches up.
+    while keys and CommentSegment.archive(blog_key, keys):
+        keys = query.fetch(COMPACT_BATCH_SIZE, keys_only=True)
+
+
+def rebuild_archive():
+    """Recounts the blogs of every month and overwrites the archive buckets.
+    Used to backfill the buckets of blogs created before the archive existed.
+    Blogs created or deleted while it runs may be miscounted, so it should be
+    run when the blog is quiet.
+
+    :return
+        A dictionary with the number of blogs and buckets written.
+    """
+    counts = collections.Counter()
+    query = Blog.query(projection=[Blog.date])
+    for blog in query.iter(batch_size=BATCH_SIZE):
+        counts[(blog.date.year, blog.date.month)] += 1
+    buckets = {}
+    for bucket in MonthBucket.query().fetch():
+        bucket.count = 0
+        buckets[(bucket.year, bucket.month)] = bucket
+    for (year, month), count in counts.iteritems():
+        bucket = buckets.get((year, month))
+        if not bucket:
+            start = datetime(year, month, 1)
+            bucket = MonthBucket(key=MonthBucket.key_for(start), year=year,
+                                 month=month, start=start)
+            buckets[(year, month)] = bucket
+        bucket.count = count
+    ndb.put_multi(buckets.values())
+    return {'blogs': sum(counts.values()), 'buckets': len(buckets)}
+
+
+def enqueue_all(queue, name):
+    """Enqueues a job for every blog.
+
+    :param queue
+        The queue used to enqueue the jobs.
+    :param name
+        The name of the job.
+    :return
+        A dictionary with the number of blogs and jobs enqueued.
+    """
+    blogs = added = 0
+    for key in Blog.query().iter(batch_size=BATCH_SIZE, keys_only=True):
+        blogs += 1
+        if queue.add(name, key.urlsafe()):
+            added += 1
+    return {'blogs': blogs, 'enqueued': added}
+
+
+def enqueue_summaries(queue):
+    """Enqueues refresh_summary for every blog. Used to backfill the
+    summaries of blogs that have not been written since summaries existed.
+
+    :param queue
+        The queue used to enqueue the jobs.
+    """
+    return enqueue_all(queue, 'refresh_summary')
+
+
+def enqueue_compactions(queue):
+    """Enqueues compact_comments for every blog. Comments are otherwise only
+    compacted when a new comment is posted, so this is run periodically from
+    cron.yaml to compact the comments of quiet blogs.
+
+    :param queue
+        The queue used to enqueue the jobs.
+    """
+    return enqueue_all(queue, 'compact_comments')
+
+
+class TaskQueue(object):
+    """Enqueues jobs in an App Engine push queue.
+
+    The queue makes tasks durable and retries failed tasks with the backoff
+    configured in queue.yaml. Coalescing relies on task names: a task named
+    after a job, blog and window can only be added once.
+    """
+
+    def __init__(self, queue_name=QUEUE_NAME):
+        self.queue_name = queue_name
+
+    def add(self, name, urlkey):
+        """Enqueues a job for a blog.
+
+        :param name
+            The name of the job.
+        :param urlkey
+            The blog key in url safe format.
+        :return
+            True if a task was added, false if it was coalesced with a pending
+            task.
+        """
+        if name not in JOBS:
+            raise ValueError('%s is not a registered job' % name)
+        countdown, index = window_countdown()
+        task = taskqueue.Task(
+            url='%s/%s' % (TASK_URL, name),
+            params={'key': urlkey},
+            name='%s-%s-%d' % (name, urlkey, index),
+            countdown=countdown + SETTLE_DELAY)
+        try:
+            task.add(queue_name=self.queue_name)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            return False
+        return True
+
+
+class LocalTaskQueue(object):
+    """An in-process stand-in for TaskQueue, for dev_appserver and local
+    scripts only.
+
+    Jobs run one at a time in a daemon thread. Tasks are lost when the process
+    goes away, but otherwise behave as in TaskQueue: jobs are coalesced while
+    pending and failed jobs are retried with exponential backoff. The worker
+    sleeps while it waits for a retry, delaying every other job.
+
+    Not usable in production: on the python27 standard runtime, threads
+    started by a request cannot outlive it.
+    """
+
+    def __init__(self, max_attempts=5, min_backoff=1, max_backoff=60):
+        """Starts the worker thread.
+
+        :param max_attempts
+            The number of times a job is run before giving up.
+        :param min_backoff
+            The delay in seconds before the first retry.
+        :param max_backoff
+            The maximum delay in seconds between retries.
+        """
+        self.max_attempts = max_attempts
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.pending = set()
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self.work)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def add(self, name, urlkey):
+        """Enqueues a job for a blog.
+
+        :param name
+            The name of the job.
+        :param urlkey
+            The blog key in url safe format.
+        :return
+            True if a task was added, false if it was coalesced with a pending
+            task.
+        """
+        if name not in JOBS:
+            raise ValueError('%s is not a registered job' % name)
+        with self._lock:
+            if (name, urlkey) in self.pending:
+                return False
+            self.pending.add((name, urlkey))
+        countdown, _ = window_countdown()
+        self._queue.put((time.time() + countdown + SETTLE_DELAY, name, urlkey))
+        return True
+
+    def work(self):
+        """Runs jobs as they become due."""
+        while True:
+            eta, name, urlkey = self._queue.get()
+            delay = eta - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            # Writes made while the job runs must schedule another run.
+            with self._lock:
+                self.pending.discard((name, urlkey))
+            self.run(name, urlkey)
+
+    def run(self, name, urlkey):
+        """Runs a job, retrying it with exponential backoff if it fails.
+
+        :param name
+            The name of the job.
+        :param urlkey
+            The blog key in url safe format.
+        """
+        backoff = self.min_backoff
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return run_job(name, urlkey)
+            except Exception:
+                logging.exception('job %s for %s failed (attempt %d)',
+                                  name, urlkey, attempt)
+            if attempt < self.max_attempts:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        logging.error('giving up on job %s for %s', name, urlkey)
+
+
+def create_queue():
+    """Creates the queue used by the handlers to enqueue jobs.
+
+    Uses the in-process LocalTaskQueue if the TASK_QUEUE environment variable
+    is set to local and the app runs in dev_appserver, and TaskQueue
+    otherwise.
+    """
+    if os.environ.get('TASK_QUEUE') != 'local':
+        return TaskQueue()
+    if not os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+        logging.warning('TASK_QUEUE=local only works in dev_appserver, '
+                        'using the task queue service')
+        return TaskQueue()
+    return LocalTaskQueue()
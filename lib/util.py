@@ -7,6 +7,7 @@ import hmac
 import random
 import re
 import string
+from datetime import datetime
 
 def gensalt(length=16):
     """Generate a random salt value for a password.
@@ -58,3 +59,19 @@ def squeeze(letters, chars):
         if letter not in chars or letter != seq[-1]:
             seq += letter
     return ''.join(seq[1:])
+
+
+def month_range(year, month):
+    """Computes the date-times where a month starts and ends.
+
+    :param year
+        The year of the month.
+    :param month
+        The month, from 1 to 12.
+    :return
+        A tuple with the start of the month and the start of the next month.
+    """
+    start = datetime(year, month, 1)
+    if month == 12:
+        return start, datetime(year + 1, 1, 1)
+    return start, datetime(year, month + 1, 1)
@@ -3,8 +3,13 @@
 Creates the app and defines its routes.
 """
 import collections
+import os
 import webapp2
+from lib import api
+from lib import cache
 from lib import handlers as hdl
+from lib import profiling
+from lib import tasks
 
 handlers = [
     (r'/', hdl.MainHandler),
@@ -22,8 +27,21 @@ handlers = [
     (r'/like/(\S+)', hdl.LikeBlogHandler),
     (r'/edit-blog/(\S+)', hdl.EditBlogHandler),
     (r'/save-blog/(\S+)', hdl.SaveBlogHandler),
-    (r'/delete-blog/(\S+)', hdl.DeleteBlogHandler)
+    (r'/delete-blog/(\S+)', hdl.DeleteBlogHandler),
+    (r'/archive', hdl.ArchiveHandler),
+    (r'/archive/(\d{4})/(\d{1,2})', hdl.ArchiveHandler),
+    (r'/api/v1/blogs', api.BlogListApiHandler),
+    (r'/api/v1/blogs/([\w-]+)', api.BlogApiHandler),
+    (r'/api/v1/blogs/([\w-]+)/comments', api.CommentListApiHandler),
+    (r'/_ah/warmup', hdl.WarmupHandler),
+    (r'/_tasks/(\w+)', hdl.RunTaskHandler),
+    (r'/_admin/backfill/(\w+)', hdl.BackfillHandler)
 ]
 app = webapp2.WSGIApplication(handlers, debug=True)
 app.registry['template_eng'] = hdl.create_template_engine('templates')
 app.registry['deleted_blogs'] = collections.deque()
+app.registry['cache'] = cache.InstanceCache()
+app.registry['tasks'] = tasks.create_queue()
+profiling.install(app, profiling.Profiler(
+    directory=os.environ.get('PROFILE_DIR'),
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0))))